@@ -6,17 +6,36 @@ import os
 import time
 import uuid
 import shutil
+import subprocess
 import serial
 import pickle
 import threading
+import queue
+import hashlib
+import collections
 import requests
-from deepface import DeepFace
-from sklearn.metrics.pairwise import cosine_similarity
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 # --- CONFIG ---
 DB_PATH = "./registered_faces"
 SAVED_NAMES_PATH = os.path.join(DB_PATH, "saved_names")
+# Single-file gallery written before galleries were kept per model
+LEGACY_GALLERY_FILE = os.path.join(SAVED_NAMES_PATH, "gallery.npz")
 IMG_PATH = "./image"
+MODEL_PATH = "./models"
+FACE_DETECTOR_MODEL = os.path.join(MODEL_PATH, "face_detection_yunet_2023mar_int8.onnx")
+DETECTION_MAX_WIDTH = 320
+FACE_RECOGNIZER_MODEL = os.path.join(MODEL_PATH, "face_recognition_sface_2021dec_int8.onnx")
+VGGFACE_ONNX_MODEL = os.path.join(MODEL_PATH, "vggface.onnx")
 WINDOW_WIDTH, WINDOW_HEIGHT = 1200, 600
 FONT = cv2.FONT_HERSHEY_SIMPLEX
 UPDATE_INTERVAL = 1
@@ -32,6 +51,14 @@ ESP32_IP = "192.168.4.1"
 ESP32_STREAM_URL = f"http://{ESP32_IP}/stream"
 ESP32_CAPTURE_URL = f"http://{ESP32_IP}/capture"
 ESP32_TIMEOUT = 5
+# appsink keeps only the newest decoded frame, so reads never lag behind the stream
+ESP32_GSTREAMER_PIPELINE = (
+    f"souphttpsrc location={ESP32_STREAM_URL} is-live=true ! multipartdemux ! "
+    "jpegdec ! videoconvert ! video/x-raw,format=BGR ! "
+    "appsink max-buffers=1 drop=true sync=false"
+)
+EMBEDDING_CACHE_SIZE = 64
+USE_OPENCL = True
 
 # Load images with error handling
 def load_image_safe(path, default_size=(150, 150)):
@@ -50,20 +77,45 @@ def load_image_safe(path, default_size=(150, 150)):
         cv2.putText(placeholder, "IMG", (20, 80), FONT, 1, (255, 255, 255), 2)
         return placeholder
 
+def prepare_overlay(img, size):
+    """Resize an overlay once and split it into premultiplied color and inverse alpha"""
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if img.shape[1::-1] != tuple(size):
+        img = cv2.resize(img, size)
+    if img.shape[2] == 4:
+        alpha = img[:, :, 3:4].astype(np.uint16)
+        return alpha * img[:, :, :3], 255 - alpha
+    return img[:, :, :3].copy(), None
+
 # Load images
 img_locked_top = load_image_safe(os.path.join(IMG_PATH, "door_locked.png"))
 img_unlocked_top = load_image_safe(os.path.join(IMG_PATH, "door_unlocked.png"))
 img_locked_bottom = load_image_safe(os.path.join(IMG_PATH, "lock.png"))
 img_unlocked_bottom = load_image_safe(os.path.join(IMG_PATH, "unlock.png"))
 
+# Status icons pre-rendered at their display size
+ICON_SIZE = (150, 150)
+icons = {
+    name: prepare_overlay(img, (min(ICON_SIZE[0], img.shape[1]), min(ICON_SIZE[1], img.shape[0])))
+    for name, img in [("locked_top", img_locked_top), ("unlocked_top", img_unlocked_top),
+                      ("locked_bottom", img_locked_bottom), ("unlocked_bottom", img_unlocked_bottom)]
+}
+
+# Let OpenCV's transparent API offload UMat work to OpenCL when available
+cv2.ocl.setUseOpenCL(USE_OPENCL and cv2.ocl.haveOpenCL())
+
 os.makedirs(DB_PATH, exist_ok=True)
 os.makedirs(SAVED_NAMES_PATH, exist_ok=True)
 
-# Initialize face cascade
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-if face_cascade.empty():
-    print("❌ Failed to load Haar cascade")
+# Initialize face detector
+try:
+    face_detector = cv2.FaceDetectorYN.create(FACE_DETECTOR_MODEL, "", (320, 240), 0.7, 0.3, 5000)
+except Exception as e:
+    print(f"❌ Failed to load YuNet face detector: {e}")
     exit()
+_detector_lock = threading.Lock()
+_detector_input_size = (320, 240)
 
 # Global variables
 arduino = None
@@ -74,9 +126,29 @@ name_map = {}
 button_clicked = None
 last_lock_state = None
 vgg_model = None
+vgg_session = None
+face_recognizer = None
+embedding_model_name = None
 esp32_connected = False
 registration_in_progress = False
 
+# Embeddings of all registered faces, dequantized once per rebuild, one row per saved vector
+_gallery = {"mat": np.zeros((0, 0), dtype=np.float32), "labels": []}
+_gallery_lock = threading.Lock()
+
+# Lines received from the ESP32 by the serial reader thread
+_serial_responses = queue.Queue()
+
+# Cached listing of user folders, keyed by the directory mtime
+_dir_cache = {"mtime": None, "users": []}
+
+# Hand-off between the GUI loop and the verification worker
+_verify_requests = queue.Queue(maxsize=1)
+_verify_results = queue.Queue()
+
+# Recent verification embeddings keyed by a hash of the downsampled face crop
+_emb_cache = collections.OrderedDict()
+
 def init_serial():
     """Initialize serial connection to ESP32"""
     global arduino
@@ -87,6 +159,10 @@ def init_serial():
         arduino.write(b"ping\n")
         time.sleep(0.5)
         response = arduino.readline().decode().strip()
+        
+        # From here on replies are collected in the background
+        threading.Thread(target=serial_reader, daemon=True).start()
+        
         if "READY" in response:
             print("✅ ESP32 Serial connection established")
             return True
@@ -109,100 +185,410 @@ def check_esp32_connection():
         esp32_connected = False
         return False
 
+def load_recognition_model():
+    """Load SFace, falling back to DeepFace's VGG-Face if its model is missing"""
+    global face_recognizer, embedding_model_name
+    if os.path.isfile(FACE_RECOGNIZER_MODEL):
+        try:
+            face_recognizer = cv2.FaceRecognizerSF.create(FACE_RECOGNIZER_MODEL, "")
+            embedding_model_name = "SFace"
+            print("✅ SFace model loaded successfully")
+            return True
+        except Exception as e:
+            print(f"⚠️ Failed to load SFace: {e}")
+    
+    print("⚠️ SFace not available, falling back to VGG-Face")
+    if load_vggface_model():
+        embedding_model_name = "VGG-Face"
+        return True
+    return False
+
 def load_vggface_model():
-    """Load VGG-Face model with error handling"""
+    """Load VGG-Face model with error handling
+    
+    Prefers ONNX Runtime (CUDA, else all CPU cores) when onnxruntime is
+    installed; the Keras model is exported to ONNX once if tf2onnx is available.
+    """
     global vgg_model
     try:
         print("🔄 Loading VGG-Face model...")
+        if ort is not None and os.path.isfile(VGGFACE_ONNX_MODEL):
+            load_vggface_onnx()
+        
+        if vgg_session is None:
+            from deepface import DeepFace
+            # Keep the underlying Keras model and call it directly
+            model = DeepFace.build_model("VGG-Face")
+            vgg_model = getattr(model, "model", model)
+            
+            if ort is not None and not os.path.isfile(VGGFACE_ONNX_MODEL):
+                load_vggface_onnx()
+        
         # Test with a dummy image to ensure model loads properly
         dummy_img = np.ones((224, 224, 3), dtype=np.uint8) * 128
-        result = DeepFace.represent(dummy_img, model_name="VGG-Face", enforce_detection=False)
-        vgg_model = True
+        run_vggface(preprocess_face(dummy_img)[None])
         print("✅ VGG-Face model loaded successfully")
         return True
     except Exception as e:
         print(f"❌ Failed to load VGG-Face: {e}")
-        vgg_model = False
+        vgg_model = None
         return False
 
-def extract_face_embedding(img):
-    """Extract face embedding using DeepFace"""
+def load_vggface_onnx():
+    """Create an ONNX Runtime session for VGG-Face, exporting the model if needed"""
+    global vgg_session
+    try:
+        if not os.path.isfile(VGGFACE_ONNX_MODEL):
+            import tensorflow as tf
+            import tf2onnx
+            print("🔄 Exporting VGG-Face to ONNX...")
+            os.makedirs(MODEL_PATH, exist_ok=True)
+            spec = (tf.TensorSpec((None, 224, 224, 3), tf.float32, name="input"),)
+            tf2onnx.convert.from_keras(vgg_model, input_signature=spec, output_path=VGGFACE_ONNX_MODEL)
+        
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = os.cpu_count() or 1
+        available = ort.get_available_providers()
+        providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in available]
+        vgg_session = ort.InferenceSession(VGGFACE_ONNX_MODEL, sess_options=options, providers=providers)
+        print(f"✅ VGG-Face running on ONNX Runtime ({vgg_session.get_providers()[0]})")
+    except Exception as e:
+        print(f"⚠️ ONNX Runtime unavailable for VGG-Face, using Keras: {e}")
+        vgg_session = None
+
+def run_vggface(batch):
+    """Forward a preprocessed batch through ONNX Runtime or Keras"""
+    if vgg_session is not None:
+        input_name = vgg_session.get_inputs()[0].name
+        return vgg_session.run(None, {input_name: batch})[0]
+    return vgg_model(batch, training=False).numpy()
+
+def preprocess_face(img, target_size=(224, 224)):
+    """Letterbox a BGR face crop into a VGG-Face input, matching DeepFace"""
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    factor = min(target_size[1] / img.shape[0], target_size[0] / img.shape[1])
+    new_w = max(1, int(img.shape[1] * factor))
+    new_h = max(1, int(img.shape[0] * factor))
+    img = cv2.resize(img, (new_w, new_h))
+    
+    pad_h = target_size[1] - new_h
+    pad_w = target_size[0] - new_w
+    img = np.pad(img, ((pad_h // 2, pad_h - pad_h // 2),
+                       (pad_w // 2, pad_w - pad_w // 2), (0, 0)), "constant")
+    return img.astype(np.float32) / 255.0
+
+def prepare_face(frame, face):
+    """Crop a detected face into the input expected by the recognition model
+    
+    SFace takes a 112x112 crop aligned on the YuNet landmarks; VGG-Face
+    takes the plain bounding-box crop.
+    """
+    if face_recognizer is not None:
+        return face_recognizer.alignCrop(frame, face)
+    x, y, w, h = get_face_box(face, frame.shape)
+    return frame[y:y+h, x:x+w]
+
+def extract_face_embeddings_batch(imgs):
+    """Embed several prepared face crops at once"""
+    try:
+        if not imgs:
+            return None
+        if face_recognizer is not None:
+            return np.stack([face_recognizer.feature(img).ravel() for img in imgs])
+        if vgg_model is None and vgg_session is None:
+            return None
+        batch = np.stack([preprocess_face(img) for img in imgs])
+        return np.asarray(run_vggface(batch), dtype=np.float32)
+    except Exception as e:
+        print(f"⚠️ Batch embedding error: {e}")
+        return None
+
+def extract_face_embedding(img, use_cache=False):
+    """Extract the embedding of a crop from prepare_face
+    
+    With use_cache, near-identical crops reuse the previous embedding.
+    Only the verification path enables it so registration always runs the model.
+    """
     try:
         if img is None or img.size == 0:
             return None
         
-        # Ensure minimum size
-        if img.shape[0] < 80 or img.shape[1] < 80:
-            img = cv2.resize(img, (80, 80))
+        key = None
+        if use_cache:
+            small = cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), (32, 32))
+            key = hashlib.blake2b(small.tobytes(), digest_size=8).digest()
+            cached = _emb_cache.get(key)
+            if cached is not None:
+                _emb_cache.move_to_end(key)
+                return cached
         
-        result = DeepFace.represent(
-            img_path=img,
-            model_name="VGG-Face",
-            enforce_detection=False
-        )
-        return result[0]["embedding"]
+        if face_recognizer is not None:
+            emb = face_recognizer.feature(img).ravel()
+        else:
+            emb = run_vggface(preprocess_face(img)[None])[0]
+        
+        if key is not None:
+            _emb_cache[key] = emb
+            if len(_emb_cache) > EMBEDDING_CACHE_SIZE:
+                _emb_cache.popitem(last=False)
+        return emb
     except Exception as e:
         print(f"⚠️ Embedding extraction error: {e}")
         return None
 
+def normalize_embeddings(emb):
+    """L2-normalize an embedding (or each row of a matrix) as float32"""
+    emb = np.asarray(emb, dtype=np.float32)
+    return emb / np.maximum(np.linalg.norm(emb, axis=-1, keepdims=True), 1e-12)
+
+def quantize_embeddings(emb):
+    """Normalize and quantize embeddings to int8 with a symmetric per-vector scale
+    
+    Returns the int8 values and the scale such that emb ~= q / scale.
+    """
+    emb = normalize_embeddings(emb)
+    scale = 127.0 / np.maximum(np.abs(emb).max(axis=-1), 1e-12)
+    q = np.round(emb * scale[..., None]).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+def gallery_path(model=None):
+    """Gallery file for a recognition model (default: the loaded one)
+    
+    Each model keeps its own file, so switching models never overwrites
+    the faces registered under the other one.
+    """
+    return os.path.join(SAVED_NAMES_PATH, f"gallery_{model or embedding_model_name}.npz")
+
+def migrate_legacy_gallery():
+    """Rename a single gallery.npz to the per-model file of the model that built it"""
+    if not os.path.isfile(LEGACY_GALLERY_FILE):
+        return
+    with np.load(LEGACY_GALLERY_FILE) as data:
+        model = str(data["model"]) if "model" in data else "VGG-Face"
+    if not os.path.isfile(gallery_path(model)):
+        os.replace(LEGACY_GALLERY_FILE, gallery_path(model))
+
+def load_gallery_file():
+    """Read quantized embeddings, their scales and labels for the loaded model"""
+    path = gallery_path()
+    if not os.path.isfile(path):
+        return (np.zeros((0, 0), dtype=np.int8), np.zeros(0, dtype=np.float32),
+                np.zeros(0, dtype="U32"))
+    with np.load(path) as data:
+        if "scale" not in data:
+            # Gallery written before embeddings were stored as int8
+            q, scale = quantize_embeddings(data["emb"])
+            return q, scale, data["labels"]
+        return data["emb"], data["scale"], data["labels"]
+
+def save_gallery_embeddings(label, embeddings):
+    """Store a person's embeddings in the model's gallery, replacing older ones
+    
+    Embeddings are normalized and quantized to int8 before saving.
+    """
+    emb, scale, labels = load_gallery_file()
+    new_emb, new_scale = quantize_embeddings(embeddings)
+    keep = labels != label
+    if keep.any():
+        emb = np.vstack([emb[keep], new_emb])
+        scale = np.concatenate([scale[keep], new_scale])
+    else:
+        emb, scale = new_emb, new_scale
+    labels = np.concatenate([labels[keep], np.full(len(new_emb), label)]).astype("U32")
+    
+    # Write to a temporary file first so a crash never leaves a torn gallery
+    tmp_path = os.path.join(SAVED_NAMES_PATH, f"gallery_{embedding_model_name}.tmp.npz")
+    np.savez(tmp_path, emb=emb, scale=scale, labels=labels, model=embedding_model_name)
+    os.replace(tmp_path, gallery_path())
+
+def migrate_legacy_embeddings():
+    """Move per-person embeddings.pkl files into the VGG-Face gallery"""
+    # Legacy pickles always hold VGG-Face embeddings
+    if embedding_model_name != "VGG-Face":
+        return
+    for folder in list_registered_users():
+        emb_path = os.path.join(SAVED_NAMES_PATH, folder, "embeddings.pkl")
+        if not os.path.isfile(emb_path):
+            continue
+        try:
+            with open(emb_path, "rb") as f:
+                saved_embs = np.asarray(pickle.load(f), dtype=np.float32)
+            if saved_embs.ndim == 2 and len(saved_embs) > 0:
+                save_gallery_embeddings(folder, saved_embs)
+            os.remove(emb_path)
+        except Exception as e:
+            print(f"⚠️ Error migrating embeddings for {folder}: {e}")
+
+def rebuild_gallery():
+    """Load the model's gallery and dequantize it into the float32 matrix used for matching"""
+    try:
+        migrate_legacy_gallery()
+        if not os.path.isfile(gallery_path()):
+            migrate_legacy_embeddings()
+        mat, scale, labels = load_gallery_file()
+    except Exception as e:
+        print(f"⚠️ Error loading gallery: {e}")
+        mat, scale, labels = (np.zeros((0, 0), dtype=np.int8), np.zeros(0, dtype=np.float32),
+                              np.zeros(0, dtype="U32"))
+    
+    mat = mat.astype(np.float32) / scale[:, None]
+    
+    with _gallery_lock:
+        _gallery["mat"] = mat
+        _gallery["labels"] = labels.tolist()
+    
+    unusable = list_unusable_users()
+    if unusable:
+        print(f"⚠️ No {embedding_model_name} embeddings for {', '.join(unusable)}; "
+              f"re-register them to use this model")
+    return len(labels)
+
 class ESP32Camera:
-    """Handle ESP32-CAM streaming"""
+    """Handle ESP32-CAM streaming
+    
+    Prefers a GStreamer pipeline whose appsink drops stale frames, then an
+    FFmpeg subprocess whose MJPEG output is split so only the newest complete
+    JPEG is kept, then OpenCV's own URL reader when ffmpeg is not on PATH.
+    A reader thread publishes each frame under a lock, so read() never
+    blocks the caller and several threads can share the camera.
+    """
     def __init__(self):
+        self.proc = None
         self.cap = None
         self.connected = False
         self.frame = None
+        self.lock = threading.Lock()
         self.thread = None
         self.running = False
     
     def connect(self):
         """Connect to ESP32-CAM stream"""
         try:
-            self.cap = cv2.VideoCapture(ESP32_STREAM_URL)
-            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Minimize buffer for real-time
+            self.cap = cv2.VideoCapture(ESP32_GSTREAMER_PIPELINE, cv2.CAP_GSTREAMER)
+            if self.cap.isOpened() and self._start_reader(self._capture_reader):
+                self.connected = True
+                print("✅ ESP32-CAM stream connected (GStreamer)")
+                return True
+            self.release()
+        except Exception as e:
+            print(f"⚠️ GStreamer pipeline failed: {e}")
+            self.release()
+        
+        try:
+            try:
+                self.proc = subprocess.Popen(
+                    ["ffmpeg", "-loglevel", "error",
+                     "-fflags", "nobuffer", "-flags", "low_delay",
+                     "-probesize", "32", "-analyzeduration", "0",
+                     "-i", ESP32_STREAM_URL,
+                     "-an", "-c:v", "copy", "-f", "mjpeg", "-"],
+                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                    stdin=subprocess.DEVNULL, bufsize=0
+                )
+                reader = self._stream_reader
+            except FileNotFoundError:
+                print("⚠️ ffmpeg not found, using OpenCV stream reader")
+                self.cap = cv2.VideoCapture(ESP32_STREAM_URL)
+                self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Minimize buffer for real-time
+                reader = self._capture_reader
             
-            # Test connection
-            ret, frame = self.cap.read()
-            if ret and frame is not None:
+            if self._start_reader(reader):
                 self.connected = True
-                self.running = True
-                self.thread = threading.Thread(target=self._stream_reader, daemon=True)
-                self.thread.start()
                 print("✅ ESP32-CAM stream connected")
                 return True
-            else:
-                self.cap.release()
-                self.connected = False
-                return False
+            
+            self.release()
+            return False
         except Exception as e:
             print(f"⚠️ ESP32-CAM connection failed: {e}")
-            self.connected = False
+            self.release()
             return False
     
-    def _stream_reader(self):
-        """Background thread to read frames"""
-        while self.running and self.cap and self.cap.isOpened():
+    def _start_reader(self, reader):
+        """Start a reader thread and wait for its first frame"""
+        self.running = True
+        self.thread = threading.Thread(target=reader, daemon=True)
+        self.thread.start()
+        
+        # Test connection
+        deadline = time.time() + ESP32_TIMEOUT
+        while time.time() < deadline and self.thread.is_alive():
+            if self.frame is not None:
+                return True
+            time.sleep(0.05)
+        return False
+    
+    def _capture_reader(self):
+        """Background thread publishing frames from a cv2.VideoCapture"""
+        cap = self.cap
+        while self.running and cap.isOpened():
             try:
-                ret, frame = self.cap.read()
-                if ret:
-                    self.frame = frame
+                ret, frame = cap.read()
+                if ret and frame is not None:
+                    with self.lock:
+                        self.frame = frame
                 else:
                     time.sleep(0.1)
             except:
                 time.sleep(0.1)
     
+    def _stream_reader(self):
+        """Background thread to split the MJPEG stream into frames"""
+        buf = bytearray()
+        while self.running and self.proc and self.proc.poll() is None:
+            try:
+                chunk = self.proc.stdout.read(65536)
+                if not chunk:
+                    time.sleep(0.1)
+                    continue
+                buf += chunk
+                
+                # Locate the last complete JPEG and drop everything before it
+                end = buf.rfind(b"\xff\xd9")
+                if end == -1:
+                    if len(buf) > 8 * 1024 * 1024:
+                        buf.clear()
+                    continue
+                start = buf.rfind(b"\xff\xd8", 0, end)
+                jpg = bytes(buf[start:end + 2]) if start != -1 else None
+                del buf[:end + 2]
+                if jpg is None:
+                    continue
+                
+                frame = cv2.imdecode(np.frombuffer(jpg, np.uint8), cv2.IMREAD_COLOR)
+                if frame is not None:
+                    # Publish by swapping the reference; the array is never reused
+                    with self.lock:
+                        self.frame = frame
+            except:
+                time.sleep(0.1)
+    
     def read(self):
-        """Get latest frame"""
-        if self.connected and self.frame is not None:
-            return True, self.frame.copy()
+        """Get latest frame
+        
+        Every decoded frame is a fresh array that the reader thread never
+        touches again, so it is returned without copying. Callers share it
+        and must not modify it in place.
+        """
+        with self.lock:
+            frame = self.frame
+        if self.connected and frame is not None:
+            return True, frame
         return False, None
     
     def release(self):
         """Release resources"""
         self.running = False
+        if self.proc:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
         if self.thread:
             self.thread.join(timeout=1)
+            self.thread = None
         if self.cap:
             self.cap.release()
+            self.cap = None
         self.connected = False
 
 def try_camera_sources():
@@ -217,6 +603,7 @@ def try_camera_sources():
             return esp32_cam
     
     # Fallback to internal camera
+    esp32_connected = False
     print("⚠️ ESP32-CAM not available, using internal camera")
     cap = cv2.VideoCapture(0)
     if cap.isOpened():
@@ -227,59 +614,151 @@ def try_camera_sources():
         print("❌ No camera available")
         return None
 
+def detect_faces(frame):
+    """Detect faces with YuNet on a downscaled frame
+    
+    Frames wider than DETECTION_MAX_WIDTH are shrunk before detection; the
+    returned YuNet rows (x, y, w, h, five landmark points, score) are scaled
+    back to full-resolution frame coordinates.
+    """
+    global _detector_input_size
+    h, w = frame.shape[:2]
+    scale = min(1.0, DETECTION_MAX_WIDTH / w)
+    if scale < 1.0:
+        small = cv2.resize(frame, (DETECTION_MAX_WIDTH, max(1, int(h * scale))),
+                           interpolation=cv2.INTER_AREA)
+    else:
+        small = frame
+    
+    with _detector_lock:
+        size = (small.shape[1], small.shape[0])
+        if size != _detector_input_size:
+            face_detector.setInputSize(size)
+            _detector_input_size = size
+        _, faces = face_detector.detect(small)
+    if faces is None:
+        return np.zeros((0, 15), dtype=np.float32)
+    
+    faces[:, :14] /= scale
+    keep = (faces[:, 2] >= MIN_FACE_SIZE[0]) & (faces[:, 3] >= MIN_FACE_SIZE[1])
+    return faces[keep]
+
+def get_face_box(face, frame_shape):
+    """Integer (x, y, w, h) of a detected face clipped to the frame"""
+    x, y, w, h = face[:4].astype(int)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, frame_shape[1]), min(y + h, frame_shape[0])
+    return x0, y0, x1 - x0, y1 - y0
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _face_check_kernel(img):
+        """Size and variance check of a BGR crop in a single pass"""
+        h, w, c = img.shape
+        if h < 50 or w < 50:
+            return False
+        s = 0.0
+        s2 = 0.0
+        for i in range(h):
+            for j in range(w):
+                for k in range(c):
+                    v = float(img[i, j, k])
+                    s += v
+                    s2 += v * v
+        n = h * w * c
+        mean = s / n
+        var = s2 / n - mean * mean
+        return 10.0 < var < 50000.0
+else:
+    _face_check_kernel = None
+
+def warm_up_face_check():
+    """Compile the Numba face check before the first real frame"""
+    if _face_check_kernel is None:
+        return
+    dummy = np.zeros((64, 64, 3), dtype=np.uint8)
+    _face_check_kernel(dummy)
+    # Face crops are non-contiguous slices of the frame, compiled separately
+    _face_check_kernel(dummy[:, :60])
+
 def is_valid_face(img):
     """Check if face image is valid"""
     if img is None or img.size == 0:
         return False
     
+    if _face_check_kernel is not None and img.ndim == 3:
+        return bool(_face_check_kernel(img))
+    
     # Check minimum size
     if img.shape[0] < 50 or img.shape[1] < 50:
         return False
     
-    # Check variance to avoid blank images
-    variance = np.var(img)
+    # Check variance to avoid blank images; combine per-channel statistics
+    # into the variance over all pixels without a float64 copy of the crop
+    mean, std = cv2.meanStdDev(img)
+    mean, std = mean.ravel(), std.ravel()
+    variance = float(np.mean(std ** 2 + mean ** 2) - np.mean(mean) ** 2)
     return 10 < variance < 50000
 
-def overlay_image(bg, img, x, y, max_size=(150, 150)):
-    """Safely overlay an image with bounds checking"""
-    try:
-        if img is None or bg is None:
-            return
-        
-        bg_h, bg_w = bg.shape[:2]
-        
-        # Ensure coordinates are within bounds
-        if x >= bg_w or y >= bg_h or x < 0 or y < 0:
-            return
-        
-        # Resize image to fit
-        img_h, img_w = img.shape[:2]
-        new_w = min(max_size[0], bg_w - x, img_w)
-        new_h = min(max_size[1], bg_h - y, img_h)
-        
-        if new_w <= 0 or new_h <= 0:
-            return
-        
-        img_resized = cv2.resize(img, (new_w, new_h))
-        
-        # Handle transparency
-        if img_resized.shape[2] == 4:
-            alpha = img_resized[:, :, 3] / 255.0
-            for c in range(3):
-                bg[y:y+new_h, x:x+new_w, c] = (
-                    alpha * img_resized[:, :, c] + 
-                    (1 - alpha) * bg[y:y+new_h, x:x+new_w, c]
-                )
-        else:
-            bg[y:y+new_h, x:x+new_w] = img_resized
-            
-    except Exception as e:
-        print(f"⚠️ Overlay error: {e}")
+def blit_overlay(bg, overlay, x, y):
+    """Blend an overlay from prepare_overlay onto bg, clipped to its bounds"""
+    color, inv_alpha = overlay
+    bg_h, bg_w = bg.shape[:2]
+    if x >= bg_w or y >= bg_h or x < 0 or y < 0:
+        return
+    
+    h = min(color.shape[0], bg_h - y)
+    w = min(color.shape[1], bg_w - x)
+    roi = bg[y:y+h, x:x+w]
+    if inv_alpha is None:
+        roi[:] = color[:h, :w]
+    else:
+        roi[:] = (color[:h, :w] + inv_alpha[:h, :w] * roi) // 255
+
+# Static GUI chrome keyed by (registration_in_progress, esp32_connected)
+_gui_templates = {}
+_gui_buffer = np.empty((WINDOW_HEIGHT, WINDOW_WIDTH, 3), dtype=np.uint8)
+
+def get_gui_template(registering, connected):
+    """Build (once) the background, labels and buttons that never change per frame"""
+    template = _gui_templates.get((registering, connected))
+    if template is not None:
+        return template
+    
+    template = np.full((WINDOW_HEIGHT, WINDOW_WIDTH, 3), 240, dtype=np.uint8)
+    
+    # Status label
+    cv2.putText(template, "Status:", (80, 260), FONT, 0.8, (0, 0, 0), 2)
+    
+    # Buttons
+    buttons = [
+        ("Saved Faces", 50, (70, 70, 70)),
+        ("Register Face", 120, (0, 100, 200) if not registering else (200, 100, 0)),
+        ("Reset System", 190, (150, 50, 50)),
+        ("Exit Program", 500, (100, 100, 100))
+    ]
+    
+    for text, y, color in buttons:
+        cv2.rectangle(template, (950, y), (1150, y+50), color, -1)
+        cv2.rectangle(template, (950, y), (1150, y+50), (0, 0, 0), 2)
+        cv2.putText(template, text, (965, y+32), FONT, 0.7, (255, 255, 255), 2)
+    
+    # Connection status
+    conn_text = "ESP32: Connected" if connected else "ESP32: Disconnected"
+    conn_color = (0, 150, 0) if connected else (0, 0, 150)
+    cv2.putText(template, conn_text, (950, 20), FONT, 0.5, conn_color, 1)
+    
+    _gui_templates[(registering, connected)] = template
+    return template
 
 def draw_layout(frame, status, is_unlocked, face_box=None, confidence=None):
-    """Draw the GUI layout with improved error handling"""
+    """Draw the GUI layout with improved error handling
+    
+    Returns a shared buffer that is overwritten by the next call.
+    """
     try:
-        gui = np.ones((WINDOW_HEIGHT, WINDOW_WIDTH, 3), dtype=np.uint8) * 240
+        gui = _gui_buffer
+        np.copyto(gui, get_gui_template(registration_in_progress, esp32_connected))
         
         # Draw title and status
         state_text = "UNLOCKED" if is_unlocked else "LOCKED"
@@ -287,10 +766,7 @@ def draw_layout(frame, status, is_unlocked, face_box=None, confidence=None):
         cv2.putText(gui, state_text, (80, 40), FONT, 1.2, color, 3)
         
         # Overlay status images
-        overlay_image(gui, img_unlocked_top if is_unlocked else img_locked_top, 75, 70)
-        
-        # Status text
-        cv2.putText(gui, "Status:", (80, 260), FONT, 0.8, (0, 0, 0), 2)
+        blit_overlay(gui, icons["unlocked_top" if is_unlocked else "locked_top"], 75, 70)
         
         # Wrap status text
         status_lines = [status[i:i+35] for i in range(0, len(status), 35)]
@@ -298,12 +774,15 @@ def draw_layout(frame, status, is_unlocked, face_box=None, confidence=None):
             cv2.putText(gui, line, (30, 290 + i*25), FONT, 0.6, (0, 0, 0), 2)
         
         # Bottom status image
-        overlay_image(gui, img_unlocked_bottom if is_unlocked else img_locked_bottom, 80, 380)
+        blit_overlay(gui, icons["unlocked_bottom" if is_unlocked else "locked_bottom"], 80, 380)
         
         # Camera feed
         if frame is not None:
             try:
-                frame_resized = cv2.resize(frame, (480, 360))
+                if cv2.ocl.useOpenCL():
+                    frame_resized = cv2.resize(cv2.UMat(frame), (480, 360)).get()
+                else:
+                    frame_resized = cv2.resize(frame, (480, 360))
                 gui[80:440, 360:840] = frame_resized
                 
                 # Draw face detection box
@@ -333,24 +812,6 @@ def draw_layout(frame, status, is_unlocked, face_box=None, confidence=None):
                 cv2.rectangle(gui, (360, 80), (840, 440), (128, 128, 128), -1)
                 cv2.putText(gui, "Camera Error", (500, 260), FONT, 1, (255, 255, 255), 2)
         
-        # Draw buttons
-        buttons = [
-            ("Saved Faces", 50, (70, 70, 70)),
-            ("Register Face", 120, (0, 100, 200) if not registration_in_progress else (200, 100, 0)),
-            ("Reset System", 190, (150, 50, 50)),
-            ("Exit Program", 500, (100, 100, 100))
-        ]
-        
-        for text, y, color in buttons:
-            cv2.rectangle(gui, (950, y), (1150, y+50), color, -1)
-            cv2.rectangle(gui, (950, y), (1150, y+50), (0, 0, 0), 2)
-            cv2.putText(gui, text, (965, y+32), FONT, 0.7, (255, 255, 255), 2)
-        
-        # Connection status
-        conn_text = "ESP32: Connected" if esp32_connected else "ESP32: Disconnected"
-        conn_color = (0, 150, 0) if esp32_connected else (0, 0, 150)
-        cv2.putText(gui, conn_text, (950, 20), FONT, 0.5, conn_color, 1)
-        
         return gui
         
     except Exception as e:
@@ -360,35 +821,75 @@ def draw_layout(frame, status, is_unlocked, face_box=None, confidence=None):
         cv2.putText(error_gui, "GUI Error", (400, 300), FONT, 2, (255, 255, 255), 3)
         return error_gui
 
+def serial_reader():
+    """Background thread queueing lines sent back by the ESP32"""
+    while arduino is not None and arduino.is_open:
+        try:
+            line = arduino.readline().decode(errors="ignore").strip()
+            if line:
+                _serial_responses.put(line)
+        except Exception:
+            # Port closed or unplugged
+            break
+
+def drain_serial_responses():
+    """Log any ESP32 replies received since the last call"""
+    while True:
+        try:
+            print(f"ESP32 Response: {_serial_responses.get_nowait()}")
+        except queue.Empty:
+            break
+
 def send_serial_command(command):
-    """Send command to ESP32 with confirmation"""
+    """Send command to ESP32 without waiting for its reply
+    
+    Replies are collected by serial_reader and logged by drain_serial_responses.
+    """
     global arduino
     if arduino:
         try:
             arduino.write((command + "\n").encode())
-            time.sleep(0.1)
-            
-            # Wait for confirmation
-            start_time = time.time()
-            while time.time() - start_time < 1:
-                if arduino.in_waiting:
-                    response = arduino.readline().decode().strip()
-                    print(f"ESP32 Response: {response}")
-                    return True
-                time.sleep(0.1)
-            return False
+            return True
         except Exception as e:
             print(f"⚠️ Serial command error: {e}")
             return False
     return False
 
-def get_face_count():
-    """Get number of registered faces"""
+def list_registered_users():
+    """Names of registered user folders, rescanned only when the directory changes"""
     try:
-        return len([d for d in os.listdir(SAVED_NAMES_PATH) 
-                   if os.path.isdir(os.path.join(SAVED_NAMES_PATH, d))])
-    except:
-        return 0
+        mtime = os.stat(SAVED_NAMES_PATH).st_mtime_ns
+        if mtime != _dir_cache["mtime"]:
+            with os.scandir(SAVED_NAMES_PATH) as entries:
+                _dir_cache["users"] = sorted(e.name for e in entries if e.is_dir())
+            _dir_cache["mtime"] = mtime
+        return _dir_cache["users"]
+    except OSError:
+        return []
+
+def invalidate_user_cache():
+    """Force the next list_registered_users call to rescan"""
+    _dir_cache["mtime"] = None
+
+def list_unusable_users():
+    """Registered users without embeddings for the loaded recognition model"""
+    with _gallery_lock:
+        known = set(_gallery["labels"])
+    return [user for user in list_registered_users() if user not in known]
+
+def close_serial():
+    """Flush pending commands (such as the final lock) and close the port"""
+    if arduino:
+        try:
+            arduino.flush()
+        except Exception as e:
+            print(f"⚠️ Serial flush error: {e}")
+        arduino.close()
+
+def get_face_count():
+    """Get number of registered faces the loaded model can match"""
+    with _gallery_lock:
+        return len(set(_gallery["labels"]))
 
 def register_face(cap):
     """Register a new face with improved feedback"""
@@ -396,7 +897,7 @@ def register_face(cap):
     
     registration_in_progress = True
     faces = []
-    embeddings = []
+    face_inputs = []
     user_id = f"Person_{person_counter}"
     user_dir = os.path.join(SAVED_NAMES_PATH, f"person_{person_counter}")
     
@@ -415,28 +916,24 @@ def register_face(cap):
                 continue
             
             # Detect faces
-            faces_detected = face_cascade.detectMultiScale(
-                frame, scaleFactor=1.1, minNeighbors=5, minSize=MIN_FACE_SIZE
-            )
+            faces_detected = detect_faces(frame)
             
             # Only process if exactly one face is detected
             if len(faces_detected) == 1:
-                x, y, w, h = faces_detected[0]
+                x, y, w, h = get_face_box(faces_detected[0], frame.shape)
                 face_img = frame[y:y+h, x:x+w]
                 
                 if is_valid_face(face_img) and time.time() - last_capture > 0.5:
-                    emb = extract_face_embedding(face_img)
-                    if emb is not None:
-                        # Save face image
-                        face_path = os.path.join(user_dir, f"{uuid.uuid4()}.jpg")
-                        cv2.imwrite(face_path, face_img)
-                        
-                        embeddings.append(emb)
-                        faces.append(face_img)
-                        last_capture = time.time()
-                        
-                        print(f"Captured face {len(faces)}/{MAX_REGISTRATION_IMAGES}")
-                        status_text = f"Capturing... {len(faces)}/{MAX_REGISTRATION_IMAGES}"
+                    # Save face image; embeddings are computed in one batch afterwards
+                    face_path = os.path.join(user_dir, f"{uuid.uuid4()}.jpg")
+                    cv2.imwrite(face_path, face_img)
+                    
+                    faces.append(face_img)
+                    face_inputs.append(prepare_face(frame, faces_detected[0]))
+                    last_capture = time.time()
+                    
+                    print(f"Captured face {len(faces)}/{MAX_REGISTRATION_IMAGES}")
+                    status_text = f"Capturing... {len(faces)}/{MAX_REGISTRATION_IMAGES}"
             
             # Show registration progress
             progress_frame = frame.copy()
@@ -449,7 +946,8 @@ def register_face(cap):
                        (10, 60), FONT, 0.7, (0, 255, 0), 2)
             
             # Draw face boxes
-            for (x, y, w, h) in faces_detected:
+            for face in faces_detected:
+                x, y, w, h = get_face_box(face, frame.shape)
                 cv2.rectangle(progress_frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
             
             cv2.imshow("Registering Face - Press ESC to cancel", progress_frame)
@@ -463,9 +961,14 @@ def register_face(cap):
         # Check if we have enough faces
         if len(faces) >= MIN_REGISTRATION_FACES:
             try:
+                status_text = "Processing captured faces..."
+                embeddings = extract_face_embeddings_batch(face_inputs)
+                if embeddings is None:
+                    raise RuntimeError("embedding extraction failed")
+                
                 # Save embeddings
-                with open(os.path.join(user_dir, "embeddings.pkl"), "wb") as f:
-                    pickle.dump(embeddings, f)
+                save_gallery_embeddings(os.path.basename(user_dir), embeddings)
+                rebuild_gallery()
                 
                 name_map[person_counter] = user_id
                 person_counter += 1
@@ -492,6 +995,7 @@ def register_face(cap):
         status_text = "Registration failed - error occurred"
     
     finally:
+        invalidate_user_cache()
         registration_in_progress = False
     
     return None
@@ -501,22 +1005,20 @@ def verify_face(frame):
     global status_text
     
     try:
-        faces = face_cascade.detectMultiScale(
-            frame, scaleFactor=1.1, minNeighbors=5, minSize=MIN_FACE_SIZE
-        )
+        faces = detect_faces(frame)
         
         if len(faces) != 1:
             status_text = "Please show only one face clearly"
             return False, None, None
         
-        x, y, w, h = faces[0]
+        x, y, w, h = get_face_box(faces[0], frame.shape)
         face_img = frame[y:y+h, x:x+w]
         
         if not is_valid_face(face_img):
             status_text = "Face not clear enough"
             return False, None, None
         
-        test_emb = extract_face_embedding(face_img)
+        test_emb = extract_face_embedding(prepare_face(frame, faces[0]), use_cache=True)
         if test_emb is None:
             status_text = "Could not process face"
             return False, (x, y, w, h), 0
@@ -524,25 +1026,14 @@ def verify_face(frame):
         best_score = 0
         best_id = None
         
-        # Compare with all registered faces
-        for folder in os.listdir(SAVED_NAMES_PATH):
-            folder_path = os.path.join(SAVED_NAMES_PATH, folder)
-            if not os.path.isdir(folder_path):
-                continue
-                
-            emb_path = os.path.join(folder_path, "embeddings.pkl")
-            if os.path.exists(emb_path):
-                try:
-                    with open(emb_path, "rb") as f:
-                        saved_embs = pickle.load(f)
-                        
-                    for emb in saved_embs:
-                        score = cosine_similarity([test_emb], [emb])[0][0]
-                        if score > best_score:
-                            best_score = score
-                            best_id = folder
-                except Exception as e:
-                    print(f"⚠️ Error loading embeddings for {folder}: {e}")
+        # Compare with all registered faces in one matrix-vector product
+        with _gallery_lock:
+            mat, labels = _gallery["mat"], _gallery["labels"]
+        
+        if labels:
+            scores = mat @ normalize_embeddings(test_emb)
+            i = int(scores.argmax())
+            best_score, best_id = float(scores[i]), labels[i]
         
         confidence_percent = best_score * 100
         
@@ -558,6 +1049,23 @@ def verify_face(frame):
         status_text = "Verification error occurred"
         return False, None, None
 
+def put_latest(q, item):
+    """Put item into a single-slot queue, replacing anything not yet taken"""
+    try:
+        q.get_nowait()
+    except queue.Empty:
+        pass
+    try:
+        q.put_nowait(item)
+    except queue.Full:
+        pass
+
+def verify_worker():
+    """Background thread running verification on the latest submitted frame"""
+    while True:
+        frame = _verify_requests.get()
+        _verify_results.put(verify_face(frame))
+
 def is_button_clicked(x, y):
     """Check if a button was clicked"""
     if 950 <= x <= 1150:
@@ -578,10 +1086,15 @@ def main():
     print("🚀 Starting Face Lock System...")
     
     # Initialize components
-    if not load_vggface_model():
-        print("❌ Cannot continue without VGG-Face model")
+    if not load_recognition_model():
+        print("❌ Cannot continue without a face recognition model")
         return
     
+    warm_up_face_check()
+    
+    # Load registered faces
+    print(f"✅ Loaded {rebuild_gallery()} saved embeddings")
+    
     # Initialize serial connection
     serial_connected = init_serial()
     if serial_connected:
@@ -602,6 +1115,9 @@ def main():
             if button_clicked == "saved_faces":
                 count = get_face_count()
                 status_text = f"Total registered faces: {count}"
+                unusable = list_unusable_users()
+                if unusable:
+                    status_text += f" ({len(unusable)} need re-registration)"
                 
             elif button_clicked == "register_face":
                 threading.Thread(target=lambda: register_face(cap), daemon=True).start()
@@ -610,6 +1126,8 @@ def main():
                 try:
                     shutil.rmtree(SAVED_NAMES_PATH, ignore_errors=True)
                     os.makedirs(SAVED_NAMES_PATH, exist_ok=True)
+                    invalidate_user_cache()
+                    rebuild_gallery()
                     person_counter = 1
                     name_map.clear()
                     is_unlocked = False
@@ -623,8 +1141,7 @@ def main():
             elif button_clicked == "quit":
                 print("👋 Shutting down...")
                 send_serial_command("lock")
-                if arduino:
-                    arduino.close()
+                close_serial()
                 if hasattr(cap, 'release'):
                     cap.release()
                 cv2.destroyAllWindows()
@@ -638,6 +1155,8 @@ def main():
     face_box = None
     confidence = None
     
+    threading.Thread(target=verify_worker, daemon=True).start()
+    
     print("✅ Face Lock System ready!")
     
     try:
@@ -646,19 +1165,27 @@ def main():
             if not ret:
                 continue
             
-            # Update face verification periodically
+            # Submit a frame for verification periodically
             current_time = time.time()
             if current_time - last_update_time > UPDATE_INTERVAL and not registration_in_progress:
-                is_unlocked, face_box, confidence = verify_face(frame)
+                put_latest(_verify_requests, frame)
+                last_update_time = current_time
+                button_clicked = None
+            
+            drain_serial_responses()
+            
+            # Pick up finished verifications without blocking the display
+            while True:
+                try:
+                    is_unlocked, face_box, confidence = _verify_results.get_nowait()
+                except queue.Empty:
+                    break
                 
                 # Send command to ESP32 if state changed
                 if last_lock_state != is_unlocked:
                     command = "lock_off" if is_unlocked else "lock_on"
                     send_serial_command(command)
                     last_lock_state = is_unlocked
-                
-                last_update_time = current_time
-                button_clicked = None
             
             # Draw and display GUI
             gui = draw_layout(frame, status_text, is_unlocked, face_box, confidence)
@@ -676,8 +1203,7 @@ def main():
     finally:
         print("🔒 Locking system...")
         send_serial_command("lock_on")
-        if arduino:
-            arduino.close()
+        close_serial()
         if hasattr(cap, 'release'):
             cap.release()
         cv2.destroyAllWindows()